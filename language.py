@@ -1,7 +1,29 @@
 import random
 import json
 import re
-from collections import defaultdict
+import bisect
+import functools
+from collections import defaultdict, deque
+
+
+def fuse_patterns(patterns):
+    """Join regexes into a single alternation, renumbering backreferences so each still points at its own group."""
+    parts = []
+    offset = 0
+    for r in patterns:
+        groups = re.compile(r).groups
+        if offset:
+            r = re.sub(r"(?<!\\)((?:\\\\)*)\\([1-9]\d?)", lambda m: f"{m.group(1)}\\{int(m.group(2)) + offset}", r)
+        parts.append(f"(?:{r})")
+        offset += groups
+    return re.compile("|".join(parts))
+
+
+def compile_restricts(restricts):
+    """Split restrictions into plain substrings and a fused regex of the rest (None if there are none)."""
+    literals = [r for r in restricts if re.escape(r) == r]
+    patterns = [r for r in restricts if re.escape(r) != r]
+    return literals, fuse_patterns(patterns) if patterns else None
 
 
 def choose(lst, exponent=2):
@@ -9,8 +31,13 @@ def choose(lst, exponent=2):
     return lst[int(x * len(lst))]
 
 
+def choose_probs(n, exponent=2):
+    """Probability of choose() picking each index of a list of length n."""
+    return [((i + 1) / n) ** (1 / exponent) - (i / n) ** (1 / exponent) for i in range(n)]
+
+
 class Language(object):
-    def __init__(self, phonemes, syll="CVC", ortho={}, wordlength=(1, 4), restricts=[]):
+    def __init__(self, phonemes, syll="CVC", ortho={}, wordlength=(1, 4), restricts=[], compiled_restricts=None):
         self.phonemes = {}
         for k, v in phonemes.items():
             v = list(v)
@@ -23,36 +50,71 @@ class Language(object):
         self.allmorphemes = set()
         self.words = defaultdict(list)
         self.restricts = restricts
+        self._build_tables(compiled_restricts)
         self.genitive = self.morpheme("of", 3)
         self.definite = self.morpheme("the", 3)
         self.joiner = random.choice("   -")
         self.minlength = 6
         self.used = []
-        self.last_n = []
+        self._used_set = set()
+        self._used_text = ""
+        self.last_n = deque(maxlen=3)
 
-    def syllable(self):
-        while True:
+    def __setstate__(self, state):
+        # Pickles from older versions lack the derived lookup tables, so always rebuild them
+        self.__dict__.update(state)
+        self.used = list(state.get("used", []))
+        self._used_set = set(self.used)
+        self._used_text = "\n".join(self.used)
+        self.last_n = deque(state.get("last_n", ()), maxlen=3)
+        self._build_tables()
+
+    def _build_tables(self, compiled_restricts=None):
+        """Derive the sampling, orthography and restriction tables from phonemes, syll, ortho and restricts."""
+        # Cumulative probabilities of choose(v, 1.5), so picking a phoneme is a single bisect
+        self._phoneme_cdfs = {
+            k: [((i + 1) / len(v)) ** (1 / 1.5) for i in range(len(v))] for k, v in self.phonemes.items()
+        }
+        # One step per template character: None for "?", else the phoneme list and its CDF
+        self._syll_plan = [None if s == "?" else (self.phonemes[s], self._phoneme_cdfs[s]) for s in self.syll]
+        self._ortho_table = str.maketrans(
+            {c: self.ortho.get(c, c.lower()) for v in self.phonemes.values() for p in v for c in p}
+        )
+        if compiled_restricts is None:
+            compiled_restricts = compile_restricts(self.restricts)
+        self._restrict_literals, self._restrict_re = compiled_restricts
+        self._syll_buffer = []
+
+    def syllables(self, n=32):
+        """Generate n candidate syllables in one pass and return those that pass the restrictions."""
+        plan = self._syll_plan
+        rand = random.random
+        bisect_right = bisect.bisect
+        sylls = []
+        for _ in range(n):
             phones = []
-            for s in self.syll:
-                if s == "?":
-                    if random.random() > 0.5:
-                        phones = phones[:-1]
+            for step in plan:
+                if step is None:
+                    if rand() > 0.5:
+                        del phones[-1:]
                 else:
-                    p = choose(self.phonemes[s], 1.5)
-                    phones.append(p)
-            syll = "".join(phones)
-            for r in self.restricts:
-                if re.search(r, syll):
-                    break
-            else:
-                return syll
+                    phones.append(step[0][bisect_right(step[1], rand())])
+            sylls.append("".join(phones))
+        literals = self._restrict_literals
+        restrict_re = self._restrict_re
+        return [
+            syll
+            for syll in sylls
+            if not any(r in syll for r in literals) and (restrict_re is None or not restrict_re.search(syll))
+        ]
+
+    def syllable(self):
+        while not self._syll_buffer:
+            self._syll_buffer = self.syllables()
+        return self._syll_buffer.pop()
 
     def orthosyll(self):
-        s = self.syllable()
-        o = ""
-        for c in s:
-            o += self.ortho.get(c, c.lower())
-        return o
+        return self.syllable().translate(self._ortho_table)
 
     def morpheme(self, key=None, maxlength=None):
         morphemes = self.morphemes[key]
@@ -77,15 +139,12 @@ class Language(object):
                 if ws[n] in self.last_n:
                     continue
                 self.last_n.append(ws[n])
-                self.last_n = self.last_n[-3:]
                 return ws[n]
             l = random.randrange(*self.wordlength)
-            keys = [key] + [None for _ in range(l - 1)]
-            random.shuffle(keys)
-            w = "".join(self.morpheme(k) for k in keys)
+            pos = random.randrange(l)
+            w = "".join(self.morpheme(key if i == pos else None) for i in range(l))
             ws.append(w)
             self.last_n.append(w)
-            self.last_n = self.last_n[-3:]
             return w
 
     def name(self, key=None, genitive=0.5, definite=0.1, minlength=5, maxlength=12):
@@ -104,15 +163,23 @@ class Language(object):
                 p = self.word(key).capitalize()
             if random.random() < definite:
                 p = self.joiner.join([self.definite, p])
-            if not hasattr(self, "used"):
-                self.used = []
-            for p2 in self.used:
-                if p in p2 or p2 in p:
-                    break
-            else:
-                if minlength <= len(p) <= maxlength:
-                    self.used.append(p)
-                    return p
+            if minlength <= len(p) <= maxlength and not self.is_used(p):
+                self.used.append(p)
+                if len(self.used) > 200:
+                    self.used = self.used[-100:]
+                    self._used_set = set(self.used)
+                    self._used_text = "\n".join(self.used)
+                else:
+                    self._used_set.add(p)
+                    self._used_text += "\n" + p
+                return p
+
+    def is_used(self, p):
+        """Check whether p contains, or is contained in, a name that has already been used."""
+        if p in self._used_text:
+            return True
+        n = len(p)
+        return any(p[i:j] in self._used_set for i in range(n) for j in range(i + 1, n + 1))
 
 
 # vsets = ["AIU", "AEIOU", "AEIOUaei", "AEIOUu", "AIUai", "EOU", "AEIOU@0u"]
@@ -169,16 +236,29 @@ class Language(object):
 # restricts = ["Ss", "sS", "LR", "RL", "FS", "Fs", "SS", "ss", r"(.)\1"]
 
 
-def get_language(family="base"):
-    with open(f"language_families/{family}.json") as fp:
+@functools.lru_cache(maxsize=None)
+def load_family(name):
+    """Load a language family definition, with its restrictions precompiled. Cached per family name."""
+    with open(f"language_families/{name}.json") as fp:
         family = json.load(fp)
+    family["compiled_restricts"] = compile_restricts(family["restricts"])
+
+    # Consonant/vowel/syllable combinations with enough variety, weighted as if drawn by choose()
+    family["phonologies"] = []
+    family["phonology_weights"] = []
+    for cset, cp in zip(family["csets"], choose_probs(len(family["csets"]))):
+        for vset, vp in zip(family["vsets"], choose_probs(len(family["vsets"]))):
+            for syll, sp in zip(family["syllsets"], choose_probs(len(family["syllsets"]), 1)):
+                if len(cset) ** syll.count("C") * len(vset) * syll.count("V") > 30:
+                    family["phonologies"].append((cset, vset, syll))
+                    family["phonology_weights"].append(cp * vp * sp)
+    return family
+
+
+def get_language(family="base"):
+    family = load_family(family)
 
-    while True:
-        cset = choose(family["csets"])
-        vset = choose(family["vsets"])
-        syll = choose(family["syllsets"], 1)
-        if len(cset) ** syll.count("C") * len(vset) * syll.count("V") > 30:
-            break
+    cset, vset, syll = random.choices(family["phonologies"], weights=family["phonology_weights"])[0]
 
     fset = choose([cset, random.choice(family["fsets"]), cset + random.choice(family["fsets"])])
     lset = choose(family["lsets"])
@@ -196,6 +276,7 @@ def get_language(family="base"):
         syll=syll,
         ortho=ortho,
         restricts=family["restricts"],
+        compiled_restricts=family["compiled_restricts"],
         wordlength=(minlength, maxlength),
     )
     return l
@@ -9,12 +9,13 @@ import scipy.spatial as spl
 import scipy.sparse as spa
 import scipy.sparse.csgraph as csg
 import scipy.sparse.linalg as sla
-from collections import defaultdict
+from collections import defaultdict, deque
 import heapq
 import noise
 import pickle
 import gzip
 import itertools
+import math
 
 tex = True
 sizemap = 15
@@ -29,34 +30,50 @@ plt.rcParams["font.size"] = 10
 
 
 def distance(a, b):
-    disp2 = (a - b) ** 2
-    if len(disp2.shape) == 2:
-        return np.sum(disp2, 1) ** 0.5
-    else:
-        return np.sum(disp2) ** 0.5
+    disp = np.subtract(a, b)
+    return np.sqrt(np.einsum("...i,...i", disp, disp))
 
 
 def trislope(xys, zs):
-    a = np.matrix(np.column_stack((xys, [1, 1, 1])))
-    b = np.asarray(zs).reshape((3, 1))
-    x = a.I * b
-    return x[0, 0], x[1, 0]
+    """Gradient (dz/dx, dz/dy) of the plane through three points, solved in closed form.
+
+    Also accepts stacks of triangles, xys of shape (..., 3, 2) and zs of shape (..., 3).
+    """
+    (x0, y0), (x1, y1), (x2, y2) = np.moveaxis(xys, (-2, -1), (0, 1))
+    z0, z1, z2 = np.moveaxis(zs, -1, 0)
+    det = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    sx = ((z1 - z0) * (y2 - y0) - (z2 - z0) * (y1 - y0)) / det
+    sy = ((x1 - x0) * (z2 - z0) - (x2 - x0) * (z1 - z0)) / det
+    return sx, sy
+
+
+def cmap_colors(cmap, values):
+    """RGBA colours for values in [0, 1], gathered straight from the colormap's 256-entry lookup table."""
+    lut = plt.get_cmap(cmap).resampled(256)(np.arange(256))
+    return lut[np.clip((np.asarray(values) * 256).astype(int), 0, 255)]
 
 
 def relaxpts(pts, idxs, n=1):
-    adj = defaultdict(list)
-    for p1, p2 in idxs:
-        adj[p1].append(p2)
-        adj[p2].append(p1)
+    """
+    Smooth a set of line segments by moving each interior endpoint to the mean of itself and its neighbours.
+    :param pts: array of point coordinates
+    :param idxs: (m, 2) array of point index pairs, one per segment
+    :param n: number of smoothing passes
+    :return: (m, 2, 2) array of relaxed segment coordinates
+    """
+    idxs = np.asarray(idxs, dtype=np.intp).reshape(-1, 2)
+    ends = idxs.ravel()
+    others = idxs[:, ::-1].ravel()
+    deg = np.bincount(ends, minlength=len(pts))
+    # Endpoints of a single segment stay put
+    moved = deg > 1
     for _ in range(n):
-        newpts = pts.copy()
-        for p in adj:
-            if len(adj[p]) == 1:
-                continue
-            adjs = adj[p] + [p]
-            newpts[p, :] = np.mean(pts[adjs, :], 0)
-        pts = newpts
-    return [[(pts[p1, 0], pts[p1, 1]), (pts[p2, 0], pts[p2, 1])] for p1, p2 in idxs]
+        sums = pts.copy()
+        for k in range(pts.shape[1]):
+            sums[:, k] += np.bincount(ends, weights=pts[others, k], minlength=len(pts))
+        pts = pts.copy()
+        pts[moved] = sums[moved] / (deg[moved, None] + 1)
+    return pts[idxs]
 
 
 def mergelines(segs):
@@ -65,60 +82,44 @@ def mergelines(segs):
 
     assert len(segs) == n
 
-    adjs = defaultdict(list)
-    for a, b in segs:
-        adjs[a].append((a, b))
-        adjs[b].append((a, b))
+    # Unconsumed segments touching each endpoint; segments are discarded here as lines absorb them
+    ends = defaultdict(set)
+    for seg in segs:
+        ends[seg[0]].add(seg)
+        ends[seg[1]].add(seg)
+
+    def take(seg):
+        segs.remove(seg)
+        ends[seg[0]].discard(seg)
+        ends[seg[1]].discard(seg)
+
     lines = []
     line = None
     nremoved = 0
     length = 0
     while segs:
         if line is None:
-            line = list(segs.pop())
+            seg = next(iter(segs))
+            take(seg)
+            line = deque(seg)
             nremoved += 1
-        found = None
-
-        for seg in adjs[line[-1]]:
-            if seg not in segs:
-                continue
 
-            if seg[0] == line[-1]:
-                line.append(seg[1])
-                found = seg
-                break
-
-            elif seg[1] == line[-1]:
-                line.append(seg[0])
-                found = seg
-                break
-
-        if found:
-            segs.remove(found)
+        if ends[line[-1]]:
+            seg = ends[line[-1]].pop()
+            take(seg)
+            line.append(seg[1] if seg[0] == line[-1] else seg[0])
             nremoved += 1
             continue
 
-        for seg in adjs[line[0]]:
-            if seg not in segs:
-                continue
-
-            if seg[0] == line[0]:
-                line.insert(0, seg[1])
-                found = seg
-                break
-
-            elif seg[1] == line[0]:
-                line.insert(0, seg[0])
-                found = seg
-                break
-
-        if found:
-            segs.remove(found)
+        if ends[line[0]]:
+            seg = ends[line[0]].pop()
+            take(seg)
+            line.appendleft(seg[1] if seg[0] == line[0] else seg[0])
             nremoved += 1
             continue
         # nothing found
 
-        lines.append(mpl.path.Path(line))
+        lines.append(mpl.path.Path(list(line)))
         length += len(line) - 1
         line = None
 
@@ -126,12 +127,54 @@ def mergelines(segs):
 
     if line is not None:
         length += len(line) - 1
-        lines.append(mpl.path.Path(line))
+        lines.append(mpl.path.Path(list(line)))
 
     print(length)
     return lines
 
 
+def shortest_route(nodes, dists, start=None, end=None):
+    """
+    Order nodes so that a path visiting each of them once is as short as possible (Held-Karp).
+    :param nodes: the nodes to visit
+    :param dists: dict mapping (a, b) to the path length from a to b
+    :param start: optional fixed node the path leaves from, not part of the returned order
+    :param end: optional fixed node the path ends at, not part of the returned order
+    """
+    nodes = list(nodes)
+    k = len(nodes)
+    if k == 0:
+        return ()
+    d = np.array([[0 if a == b else dists[a, b] for b in nodes] for a in nodes], float)
+    first = np.zeros(k) if start is None else np.array([dists[start, b] for b in nodes], float)
+    last = np.zeros(k) if end is None else np.array([dists[a, end] for a in nodes], float)
+
+    # cost[mask, j]: shortest path through the nodes in mask, ending at node j
+    full = 1 << k
+    cost = np.full((full, k), np.inf)
+    parent = np.full((full, k), -1)
+    cost[1 << np.arange(k), np.arange(k)] = first
+    for mask in range(1, full):
+        js = np.array([j for j in range(k) if not mask >> j & 1], int)
+        if not len(js):
+            continue
+        cand = cost[mask][:, None] + d[:, js]
+        best_i = cand.argmin(0)
+        best = cand[best_i, np.arange(len(js))]
+        newmasks = mask | (1 << js)
+        better = best < cost[newmasks, js]
+        cost[newmasks[better], js[better]] = best[better]
+        parent[newmasks[better], js[better]] = best_i[better]
+
+    order = []
+    mask = full - 1
+    j = int(np.argmin(cost[mask] + last))
+    while j != -1:
+        order.append(nodes[j])
+        mask, j = mask & ~(1 << j), int(parent[mask, j])
+    return tuple(order[::-1])
+
+
 def load(filename):
     with gzip.open(filename) as f:
         return pickle.loads(f.read())
@@ -177,6 +220,7 @@ class MapGrid:
         self.name_places()
         self.path_cache = {}
         self.fill_path_cache(self.big_cities)
+        self._draw_cache = None
 
     @property
     def big_cities(self):
@@ -190,6 +234,16 @@ class MapGrid:
         with gzip.open(filename, "w") as f:
             f.write(pickle.dumps(self))
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Caches added after a map was pickled start out empty
+        self.__dict__.setdefault("_flow_downhill", None)
+        self.__dict__.setdefault("_draw_cache", None)
+        # Older pickles key the path cache by (start, end) only
+        self.path_cache = {
+            key if len(key) == 3 else (*key, frozenset()): value for key, value in self.path_cache.items()
+        }
+
     def build_grid(self, n):
         """
         Build the map grid. Spreads points and runs a few iterations of improvement to make a nice initial grid.
@@ -206,10 +260,13 @@ class MapGrid:
         self.nvxs = self.vxs.shape[0]
         self.build_adjs()
         self.improve_vxs()
+        # Horizontal length of each adjacency slot; vertex positions are fixed from here on
+        self.adj_dist = np.where(self.adj_valid, distance(self.vxs[:, None, :], self.vxs[self.adj_mat]), np.inf)
         self.calc_edges()
         self.distort_vxs()
         self.elevation = np.zeros(self.nvxs + 1)
         self.erodability = np.ones(self.nvxs)
+        self._flow_downhill = None
 
     def do_erosion(self, n, rate=0.01):
         """
@@ -232,8 +289,9 @@ class MapGrid:
         :param perc: the elevation percentile to place sea level at
         """
         maxheight = self.elevation.max()
-        self.elevation -= np.percentile(self.elevation, perc)
-        self.elevation *= maxheight / self.elevation.max()
+        sealevel = np.percentile(self.elevation, perc)
+        self.elevation -= sealevel
+        self.elevation *= maxheight / (maxheight - sealevel)
         self.elevation[-1] = 0
 
     def finalize(self):
@@ -252,27 +310,30 @@ class MapGrid:
 
     def improve_pts(self, n=2):
         print("Improving points")
+        npts = self.pts.shape[0]
         for _ in range(n):
             vor = spl.Voronoi(self.pts)
-            newpts = []
-            for idx in range(len(vor.points)):
-                pt = vor.points[idx, :]
-                region = vor.regions[vor.point_region[idx]]
-                if -1 in region:
-                    newpts.append(pt)
-                else:
-                    vxs = np.asarray([vor.vertices[i, :] for i in region])
-                    vxs[vxs < 0] = 0
-                    vxs[vxs > 1] = 1
-                    newpt = np.mean(vxs, 0)
-                    newpts.append(newpt)
-            self.pts = np.asarray(newpts)
+            regions = [vor.regions[i] for i in vor.point_region]
+            pt_idx = np.repeat(np.arange(npts), [len(r) for r in regions])
+            vx_idx = np.fromiter(itertools.chain.from_iterable(regions), np.int32)
+            # Points whose region is unbounded stay where they are
+            boundary = np.bincount(pt_idx[vx_idx == -1], minlength=npts) > 0
+            vxs = np.clip(vor.vertices[vx_idx, :], 0, 1)
+            counts = np.maximum(np.bincount(pt_idx, minlength=npts), 1)
+            newpts = np.column_stack([np.bincount(pt_idx, weights=vxs[:, k], minlength=npts) for k in range(2)])
+            newpts /= counts[:, None]
+            newpts[boundary] = vor.points[boundary]
+            self.pts = newpts
 
     def improve_vxs(self):
         print("Improving vertices")
         n = self.nvxs
-        for v in range(n):
-            self.vxs[v, :] = np.mean(self.pts[self.vx_regions[v]], 0)
+        finite = self.region_vx_idx != -1
+        vx_idx = self.region_vx_idx[finite]
+        pts = self.pts[self.region_pt_idx[finite], :]
+        counts = np.maximum(np.bincount(vx_idx, minlength=n), 1)
+        for k in range(2):
+            self.vxs[:, k] = np.bincount(vx_idx, weights=pts[:, k], minlength=n) / counts
 
     def build_adjs(self):
         print("Building adjacencies")
@@ -284,6 +345,9 @@ class MapGrid:
         for v1, v2 in self.vor.ridge_vertices:
             self.adj_vxs[v1].append(v2)
             self.adj_vxs[v2].append(v1)
+        # Flat (point, vertex) incidence of the Voronoi regions; -1 marks a vertex at infinity
+        self.region_pt_idx = np.repeat(np.arange(self.pts.shape[0]), [len(r) for r in self.regions])
+        self.region_vx_idx = np.fromiter(itertools.chain.from_iterable(self.regions), np.int32)
         self.vx_regions = defaultdict(list)
         for p in range(self.pts.shape[0]):
             for v in self.regions[p]:
@@ -297,24 +361,21 @@ class MapGrid:
         for k, v in self.adj_vxs.items():
             if k != -1:
                 self.adj_mat[k, :] = v
+        self.adj_valid = self.adj_mat != -1
 
     def calc_edges(self):
-        n = self.nvxs
-        self.edge = np.zeros(n, bool)
-        for u in range(n):
-            adjs = self.adj_vxs[u]
-            if -1 in adjs:  # or \
-                #                     np.all(self.vxs[adjs,0] > self.vxs[u,0]) or \
-                #                     np.all(self.vxs[adjs,0] < self.vxs[u,0]) or \
-                #                     np.all(self.vxs[adjs,1] > self.vxs[u,1]) or \
-                #                     np.all(self.vxs[adjs,1] < self.vxs[u,1]):
-                self.edge[u] = True
+        self.edge = ~self.adj_valid.all(1)
 
     def perlin(self, base=None):
         if base is None:
             base = np.random.randint(1000)
 
-        perlin_noise = np.array([noise.pnoise2(x, y, lacunarity=1.7, octaves=3, base=base) for x, y in self.vxs])
+        # Plain floats from tolist() are cheaper to unpack and pass to pnoise2 than numpy scalars
+        perlin_noise = np.fromiter(
+            (noise.pnoise2(x, y, lacunarity=1.7, octaves=3, base=base) for x, y in self.vxs.tolist()),
+            float,
+            self.nvxs,
+        )
         return perlin_noise
 
     def distort_vxs(self):
@@ -347,8 +408,9 @@ class MapGrid:
         self.elevation[:-1] = 0.5 + ((self.dvxs - 0.5) * np.random.normal(0, 4, (1, 2))).sum(1)
         self.elevation[:-1] += -4 * (np.random.random() - 0.5) * distance(self.vxs, 0.5)
         mountains = np.random.random((50, 2))
-        for m in mountains:
-            self.elevation[:-1] += np.exp(-distance(self.vxs, m) ** 2 / (2 * 0.05 ** 2)) ** 2
+        # exp(-d^2 / (2 r^2)) ** 2 == exp(-d^2 / r^2), summed over all mountains at once
+        d2 = ((self.vxs[:, None, :] - mountains[None, :, :]) ** 2).sum(2)
+        self.elevation[:-1] += np.exp(-d2 / 0.05 ** 2).sum(1)
         print("Edge height:", self.elevation[:-1][self.edge].max())
 
         along = (((self.dvxs - 0.5) * np.random.normal(0, 2, (1, 2))).sum(1) + np.random.normal(0, 0.5)) * 10
@@ -403,8 +465,9 @@ class MapGrid:
         y = (dvxs[:, 0] - 0.5) * -np.sin(theta) + (dvxs[:, 1] - 0.5) * np.cos(theta)
         self.elevation[:-1] = 50 - 10 * np.abs(x)
         mountains = np.random.random((50, 2))
-        for m in mountains:
-            self.elevation[:-1] += np.exp(-distance(self.vxs, m) ** 2 / (2 * 0.05 ** 2)) ** 2
+        # exp(-d^2 / (2 r^2)) ** 2 == exp(-d^2 / r^2), summed over all mountains at once
+        d2 = ((self.vxs[:, None, :] - mountains[None, :, :]) ** 2).sum(2)
+        self.elevation[:-1] += np.exp(-d2 / 0.05 ** 2).sum(1)
         self.erodability[:] = np.exp(50 - 10 * self.elevation[:-1])
         for _ in range(5):
             self.rift()
@@ -423,47 +486,62 @@ class MapGrid:
         self.elevation[:-1] -= self.elevation[:-1].min() - 0.1
 
     def relax(self):
-        newelev = np.zeros_like(self.elevation[:-1])
-        for u in range(self.nvxs):
-            adjs = [v for v in self.adj_vxs[u] if v != -1]
-            if len(adjs) < 2:
-                continue
-            newelev[u] = np.mean(self.elevation[adjs])
-        self.elevation[:-1] = newelev
+        """Replace each elevation with the mean of its neighbours (0 where fewer than two neighbours exist)."""
+        nadj = self.adj_valid.sum(1)
+        adjsum = np.where(self.adj_valid, self.elevation[self.adj_mat], 0).sum(1)
+        self.elevation[:-1] = np.where(nadj >= 2, adjsum / np.maximum(nadj, 1), 0)
 
     def normalize_elevation(self):
         self.elevation -= self.elevation.min()
-        if self.elevation.max() > 0:
-            self.elevation /= self.elevation.max()
-        self.elevation[self.elevation < 0] = 0
-        self.elevation = self.elevation ** 0.5
+        maxheight = self.elevation.max()
+        if maxheight > 0:
+            self.elevation /= maxheight
+        np.maximum(self.elevation, 0, out=self.elevation)
+        np.sqrt(self.elevation, out=self.elevation)
 
     def calc_elevation_pts(self):
         npts = self.pts.shape[0]
-        self.elevation_pts = np.zeros(npts)
-        for p in range(npts):
-            if self.regions[p]:
-                self.elevation_pts[p] = np.mean(self.elevation[self.regions[p]])
+        # -1 entries pick up the zero sentinel elevation[-1], as in a per-region np.mean
+        sums = np.bincount(self.region_pt_idx, weights=self.elevation[self.region_vx_idx], minlength=npts)
+        counts = np.bincount(self.region_pt_idx, minlength=npts)
+        self.elevation_pts = sums / np.maximum(counts, 1)
 
     def calc_downhill(self):
         n = self.nvxs
-        dhidxs = np.argmin(self.elevation[self.adj_mat], 1)
+        # Missing neighbours are masked out rather than read through the elevation[-1] sentinel
+        adjelevs = np.where(self.adj_valid, self.elevation[self.adj_mat], np.inf)
+        dhidxs = np.argmin(adjelevs, 1)
         downhill = self.adj_mat[np.arange(n), dhidxs]
-        downhill[self.elevation[:-1] <= self.elevation[downhill]] = -1
+        downhill[self.elevation[:-1] <= adjelevs[np.arange(n), dhidxs]] = -1
         downhill[self.edge] = -1
         self.downhill = downhill
+        self.downhill_slot = dhidxs
 
     def calc_flow(self):
         n = self.nvxs
+        # Rain is uniform, so the solve only depends on downhill; reuse it while drainage is unchanged
+        if self._flow_downhill is not None and np.array_equal(self.downhill, self._flow_downhill):
+            self.flow = self._drainage.copy()
+            self.flow[self.elevation[:-1] <= 0] = 0
+            return
         rain = np.ones(n) / n
-        i = self.downhill[self.downhill != -1]
-        j = np.arange(n)[self.downhill != -1]
-        dmat = spa.eye(n) - spa.coo_matrix((np.ones_like(i), (i, j)), (n, n)).tocsc()
-        self.flow = sla.spsolve(dmat, rain)
+        # I - P built straight in CSC form: column j holds 1 on the diagonal and -1 at its downhill row
+        valid = self.downhill != -1
+        indptr = np.concatenate(([0], np.cumsum(1 + valid)))
+        starts = indptr[:-1]
+        indices = np.empty(indptr[-1], np.int32)
+        data = np.ones(indptr[-1])
+        indices[starts] = np.arange(n)
+        indices[starts[valid] + 1] = self.downhill[valid]
+        data[starts[valid] + 1] = -1
+        dmat = spa.csc_matrix((data, indices, indptr), (n, n))
+        self._drainage = sla.spsolve(dmat, rain)
+        self._flow_downhill = self.downhill.copy()
+        self.flow = self._drainage.copy()
         self.flow[self.elevation[:-1] <= 0] = 0
 
     def calc_slopes(self):
-        dist = distance(self.vxs, self.vxs[self.downhill, :])
+        dist = self.adj_dist[np.arange(self.nvxs), self.downhill_slot]
         self.slope = (self.elevation[:-1] - self.elevation[self.downhill]) / (dist + 1e-9)
         self.slope[self.downhill == -1] = 0
 
@@ -481,30 +559,23 @@ class MapGrid:
         sinklist = np.where((sinks == -1) & ~water & ~self.edge)[0]
         sinks[sinklist] = sinklist
         sinks[water] = -1
-        while True:
-            newsinks = sinks.copy()
-            newsinks[~water] = sinks[sinks[~water]]
-            newsinks[sinks == -1] = -1
-            if np.all(sinks == newsinks):
-                break
-            sinks = newsinks
+        # Pointer jumping, only revisiting vertices whose target is still moving
+        active = np.where(sinks != -1)[0]
+        while active.size:
+            jumped = sinks[sinks[active]]
+            moving = (jumped != sinks[active]) & (jumped != -1)
+            sinks[active] = jumped
+            active = active[moving]
         return sinks
 
     def find_lowest_sill(self, sinks):
-        h = 10000
-        edges = np.where((sinks != -1) & np.any((sinks[self.adj_mat] == -1) & self.adj_mat != -1, 1))[0]
-
-        for u in edges:
-            adjs = [v for v in self.adj_vxs[u] if v != -1]
-            for v in adjs:
-                if sinks[v] == -1:
-                    newh = max(self.elevation[v], self.elevation[u])
-                    if newh < h:
-                        h = newh
-                        bestuv = u, v
+        # Height of every edge leaving a sink's basin; argmin keeps the first (u, slot) on ties
+        crossing = self.adj_valid & (sinks[:, None] != -1) & (sinks[self.adj_mat] == -1)
+        heights = np.where(crossing, np.maximum(self.elevation[:-1, None], self.elevation[self.adj_mat]), np.inf)
+        u, slot = divmod(np.argmin(heights), heights.shape[1])
+        h = heights[u, slot]
         assert h < 10000
-        u, v = bestuv
-        return h, u, v
+        return h, u, self.adj_mat[u, slot]
 
     def infill(self):
         tries = 0
@@ -531,24 +602,20 @@ class MapGrid:
             self.calc_downhill()
 
     def clean_coast(self, n=3, outwards=True):
+        # Interior vertices have three real neighbours, so adj_mat needs no -1 masking here
+        inner = ~self.edge
         for _ in range(n):
+            adjelevs = self.elevation[self.adj_mat]
+            wet = adjelevs <= 0
+            spit = inner & (self.elevation[:-1] > 0) & ((~wet).sum(1) == 1)
             new_elev = self.elevation[:-1].copy()
-            for u in range(self.nvxs):
-                if self.edge[u] or self.elevation[u] <= 0:
-                    continue
-                adjs = self.adj_vxs[u]
-                adjelevs = self.elevation[adjs]
-                if np.sum(adjelevs > 0) == 1:
-                    new_elev[u] = np.mean(adjelevs[adjelevs <= 0])
+            new_elev[spit] = np.where(wet, adjelevs, 0).sum(1)[spit] / wet.sum(1)[spit]
             self.elevation[:-1] = new_elev
             if outwards:
-                for u in range(self.nvxs):
-                    if self.edge[u] or self.elevation[u] > 0:
-                        continue
-                    adjs = self.adj_vxs[u]
-                    adjelevs = self.elevation[adjs]
-                    if np.sum(adjelevs <= 0) == 1:
-                        new_elev[u] = np.mean(adjelevs[adjelevs > 0])
+                adjelevs = self.elevation[self.adj_mat]
+                wet = adjelevs <= 0
+                inlet = inner & (self.elevation[:-1] <= 0) & (wet.sum(1) == 1)
+                new_elev[inlet] = np.where(wet, 0, adjelevs).sum(1)[inlet] / (~wet).sum(1)[inlet]
                 self.elevation[:-1] = new_elev
 
     def place_cities(self, n=20):
@@ -560,6 +627,7 @@ class MapGrid:
         self.city_score = self.flow ** 0.5
         self.city_score[self.elevation[:-1] <= 0] = -9999999
         self.cities = []
+        vxs_sqnorm = (self.vxs ** 2).sum(1)
         while len(self.cities) < n:
             # location of potential new city is place with maximum score
             newcity = np.argmax(self.city_score)
@@ -579,10 +647,13 @@ class MapGrid:
 
             #import pdb
             #pdb.set_trace()
-            self.city_score -= 0.01 * 1 / (distance(self.vxs, self.vxs[newcity, :]) + 1e-9)
+            # |v - c|^2 = |v|^2 + |c|^2 - 2 v.c, clamped against rounding below zero
+            c = self.vxs[newcity, :]
+            dist = np.sqrt(np.maximum(vxs_sqnorm + c @ c - 2 * (self.vxs @ c), 0))
+            self.city_score -= 0.01 * 1 / (dist + 1e-9)
 
     def edge_weight(self, u, v, territory=False):
-        horiz = distance(self.vxs[u, :], self.vxs[v, :])
+        horiz = math.hypot(self.vxs[u, 0] - self.vxs[v, 0], self.vxs[u, 1] - self.vxs[v, 1])
         vert = self.elevation[v] - self.elevation[u]
         if vert < 0:
             vert /= 10
@@ -598,45 +669,67 @@ class MapGrid:
             difficulty = 2000 if territory else 200
         return horiz * difficulty
 
+    def edge_weights(self, u, v, territory=False):
+        """Vectorised edge_weight over arrays of vertex pairs."""
+        horiz = distance(self.vxs[u, :], self.vxs[v, :])
+        vert = self.elevation[v] - self.elevation[u]
+        vert = np.where(vert < 0, vert / 10, vert)
+        difficulty = 1 + (vert / horiz) ** 2
+        if territory:
+            difficulty += 100 * self.flow[u] ** 0.5
+        else:
+            difficulty[(self.downhill[u] == v) | (self.downhill[v] == u)] *= 0.9
+        wet_u = self.elevation[u] <= 0
+        difficulty[wet_u] = 1
+        difficulty[wet_u != (self.elevation[v] <= 0)] = 2000 if territory else 200
+        return horiz * difficulty
+
     def fill_path_cache(self, cities):
         cities = list(cities)
         n = self.vxs.shape[0]
-        g = spa.dok_matrix((n + 2, n + 2))
         edge = self.extend_area(self.edge, 5)
-        for u in range(n):
-            for v in self.adj_vxs[u]:
-                if not (edge[u] and edge[v]):
-                    g[u, v] = self.edge_weight(u, v)
-            if edge[u]:
-                d = self.vxs[u, 0] - self.vxs[u, 1]
-                if d < -0.5:
-                    g[n, u] = 1e-12
-                if d > 0.5:
-                    g[u, n + 1] = 1e-12
-        g = g.tocsc()
+        u = np.repeat(np.arange(n), self.adj_mat.shape[1])
+        v = self.adj_mat.ravel()
+        keep = (v != -1) & ~(edge[u] & edge[v])
+        u, v = u[keep], v[keep]
+        # Zero-cost links from virtual corner nodes n ("topleft") and n + 1 ("bottomright") to the map edge
+        d = self.vxs[:, 0] - self.vxs[:, 1]
+        topleft = np.where(edge & (d < -0.5))[0]
+        bottomright = np.where(edge & (d > 0.5))[0]
+        rows = np.concatenate((u, np.full(len(topleft), n), bottomright))
+        cols = np.concatenate((v, topleft, np.full(len(bottomright), n + 1)))
+        weights = np.concatenate((self.edge_weights(u, v), np.full(len(topleft) + len(bottomright), 1e-12)))
+        g = spa.csc_matrix((weights, (rows, cols)), (n + 2, n + 2))
         tocities = cities + [n + 1]
         fromcities = cities + [n]
         dists, preds = csg.dijkstra(g, indices=fromcities, return_predecessors=True)
 
-        for b in tocities:
-            for i, a in enumerate(fromcities):
+        # Walk the predecessor trees back from every target and reverse, rather than prepending step by step
+        for i, a in enumerate(fromcities):
+            pred = preds[i].tolist()
+            for b in tocities:
                 if a == b:
                     continue
                 p = [b]
-                while p[0] != a:
-                    p.insert(0, preds[i, p[0]])
-                p = [x for x in p if x < n]
+                while p[-1] != a:
+                    p.append(pred[p[-1]])
+                p = [x for x in reversed(p) if x < n]
                 d = dists[i, b]
-                self.path_cache["topleft" if a == n else a, "bottomright" if b == n + 1 else b] = (p, d)
+                self.path_cache["topleft" if a == n else a, "bottomright" if b == n + 1 else b, frozenset()] = (p, d)
 
     def shortest_path(
         self,
         start,
         end,
+        excluded=frozenset(),
     ):
+        """
+        Find a path between two cities (or the "topleft"/"bottomright" map corners).
+        :param excluded: frozenset of (u, v) vertex pairs that may not be crossed in either direction
+        """
         try:
-            if self.path_cache[start, end]:
-                return self.path_cache[start, end]
+            if self.path_cache[start, end, excluded]:
+                return self.path_cache[start, end, excluded]
         except KeyError:
             print("WARNING: Uncached path search", start, end)
         except Exception as e:
@@ -649,6 +742,11 @@ class MapGrid:
         if isinstance(end, str):
             flipped = True
             start, end = end, start
+        # A* heuristic towards end, computed for every vertex up front
+        est_to_end = (0.85 * distance(self.vxs, self.vxs[end, :])).tolist()
+        adj_vxs = self.adj_vxs
+        edge = self.edge
+        edge_weight = self.edge_weight
         heapq.heappush(q, (0, 0, end, -1))
         while start not in best_dir:
             _, dist, u, v = heapq.heappop(q)
@@ -662,38 +760,46 @@ class MapGrid:
                     while path[-1] != end:
                         path.append(best_dir[path[-1]])
                     if flipped:
-                        self.path_cache[end, u] = path[::-1], dist
+                        self.path_cache[end, u, excluded] = path[::-1], dist
                         print("CACHE", len(self.path_cache))
                     else:
-                        self.path_cache[u, end] = path, dist
+                        self.path_cache[u, end, excluded] = path, dist
                         print("CACHE", len(self.path_cache))
                 length = dist
-            if isinstance(start, str) and self.edge[u]:
+            if isinstance(start, str) and edge[u]:
                 if (start == "topleft" and self.vxs[u, 0] - self.vxs[u, 1] < -0.5) or (
                     start == "bottomright" and self.vxs[u, 0] - self.vxs[u, 1] > 0.5
                 ):
                     start = u
                     break
-            for w in self.adj_vxs[u]:
-                if w == -1 or w in best_dir or (self.edge[u] and self.edge[w]):
+            for w in adj_vxs[u]:
+                if w == -1 or w in best_dir or (edge[u] and edge[w]):
                     continue
-                est = distance(self.vxs[end, :], self.vxs[w, :]) * 0.85
-                d = dist + self.edge_weight(w, u)
-                heapq.heappush(q, (d + est, d, w, u))        
+                if excluded and ((u, w) in excluded or (w, u) in excluded):
+                    continue
+                est = est_to_end[w]
+                d = dist + edge_weight(w, u)
+                heapq.heappush(q, (d + est, d, w, u))
         path = [start]
         while path[-1] != end:
             path.append(best_dir[path[-1]])
         if flipped:
-            self.path_cache[end, start] = path[::-1], length
+            self.path_cache[end, start, excluded] = path[::-1], length
             print("CACHE", len(self.path_cache))
             return path[::-1], length
         else:
-            self.path_cache[start, end] = path, length
+            self.path_cache[start, end, excluded] = path, length
             print("CACHE", len(self.path_cache))
             return path, length
 
     def grow_territory(self, n=7):
         done = np.zeros(self.nvxs, np.int32) - 1
+        # Cost of stepping from each adjacency slot's vertex into the row's vertex, as plain Python lists
+        weights = np.full(self.adj_mat.shape, np.inf)
+        vx = np.repeat(np.arange(self.nvxs)[:, None], self.adj_mat.shape[1], 1)
+        weights[self.adj_valid] = self.edge_weights(self.adj_mat[self.adj_valid], vx[self.adj_valid], territory=True)
+        weights = weights.tolist()
+        adjs = self.adj_mat.tolist()
         q = []
         for city in self.cities[:n]:
             heapq.heappush(q, (0, city, city))
@@ -702,10 +808,9 @@ class MapGrid:
             if done[vx] != -1:
                 continue
             done[vx] = city
-            for u in self.adj_vxs[vx]:
-                if done[u] != -1 or u == -1:
+            for u, newdist in zip(adjs[vx], weights[vx]):
+                if u == -1 or done[u] != -1:
                     continue
-                newdist = self.edge_weight(u, vx, territory=True)
                 heapq.heappush(q, (dist + newdist, u, city))
         self.territories = done
     
@@ -715,12 +820,11 @@ class MapGrid:
         self.forest_score = self.flow ** 0.5
         self.forest_score[self.elevation[:-1] <= 0] = -9999999
         self.forests =set([])
-        while len(self.forests) < n:
-            # location of potential new forests is place with maximum score
-            newforests = np.argmax(self.forest_score)
-            if self.forest_score[newforests] == -9999999:
+        # Candidate locations from highest to lowest score, land only; ties go to the lowest index like argmax
+        order = np.argsort(-self.forest_score, kind="stable")
+        for newforests in order[self.forest_score[order] != -9999999]:
+            if len(self.forests) >= n:
                 break
-            self.forest_score[newforests] = -9999999
             # Only place forest between 0 and 1 axes.
             forests_max_ax = 1
             forests_min_ax = 0
@@ -730,9 +834,9 @@ class MapGrid:
                 and forests_min_ax < self.vxs[newforests, 0] < forests_max_ax
                 and forests_min_ax < self.vxs[newforests, 1] < forests_max_ax
             ):
-                flat_list = [item for sublist in [k for k in self.regions if newforests in k] for item in sublist]
-                self.forests = self.forests.union(flat_list)
-                #self.forests = set([item for sublist in self.forests for item in sublist])
+                # Cover every region around the vertex
+                for p in self.vx_regions[newforests]:
+                    self.forests.update(self.regions[p])
 
     def extend_area(self, area, n):
         for _ in range(10):
@@ -751,12 +855,7 @@ class MapGrid:
             dists["topleft", c] = self.shortest_path("topleft", c)[1]
             dists[c, "bottomright"] = self.shortest_path(c, "bottomright")[1]
 
-        def totallength(seq):
-            seq = ["topleft"] + list(seq) + ["bottomright"]
-            return sum(dists[c, d] for c, d in zip(seq[:-1], seq[1:]))
-
-        clist = min(itertools.permutations(cities), key=totallength)
-        return clist
+        return shortest_route(cities, dists, "topleft", "bottomright")
     
     def ordered_cities_region(self, cities):
         cities = cities
@@ -767,14 +866,144 @@ class MapGrid:
                     continue
                 dists[c, d] = self.shortest_path(c, d)[1]
 
-        def totallength(seq):
-            return sum(dists[c, d] for c, d in zip(seq[:-1], seq[1:]))
-
-        clist = min(itertools.permutations(cities), key=totallength)
-        return clist
+        return shortest_route(cities, dists)
 
     RIVER_COLOR = mpl.cm.Blues(0.55)
 
+    def draw_geometry(self, rivers=True):
+        """
+        Build the land and sea patches, slope lines, rivers, borders and coasts drawn by plot().
+        The result is cached and reused until the elevation or territories change, so the same map can be
+        saved at several resolutions without redoing this work. Rivers are only built when asked for, and are
+        rebuilt whenever downhill, flow or riverperc change.
+        :param rivers: whether to include the river lines
+        """
+        geometry = None
+        if self._draw_cache is not None:
+            elevation, territories, geometry = self._draw_cache
+            if not (np.array_equal(elevation, self.elevation) and np.array_equal(territories, self.territories)):
+                geometry = None
+        if geometry is None:
+            geometry = self._build_geometry()
+            self._draw_cache = (self.elevation.copy(), self.territories.copy(), geometry)
+
+        if rivers:
+            key = geometry.get("river_key")
+            if not (
+                key is not None
+                and np.array_equal(key[0], self.downhill)
+                and np.array_equal(key[1], self.flow)
+                and key[2] == self.riverperc
+            ):
+                geometry["rivers"] = self._build_rivers(geometry["good"], geometry["land_mask"])
+                geometry["river_key"] = (self.downhill.copy(), self.flow.copy(), self.riverperc)
+        return geometry
+
+    def _build_geometry(self):
+        land_mask = self.elevation[:-1] > 0
+        good = ~self.extend_area(self.edge, 10)
+
+        goodidxs = np.flatnonzero(good)
+        # Every Voronoi vertex is the circumcentre of exactly three points
+        tris = np.array([self.tris[i] for i in goodidxs], dtype=np.int32)
+        good_land = land_mask[goodidxs]
+        elevations = self.elevation[goodidxs]
+
+        # Slope lines, skipping the ocean
+        r = 0.25 * self.nvxs ** -0.5
+        land = np.flatnonzero(good_land)
+        t = tris[land]
+        slopes, slopes2 = trislope(self.pts[t], self.elevation_pts[t])
+        slopes /= 10
+
+        # Do not add a line if slope is below threshold
+        drawn = np.abs(slopes) >= 0.1 + 0.3 * np.random.random(len(slopes))
+        s = slopes[drawn]
+        l = r * (1 + np.random.random(len(s))) * (1 - 0.2 * np.arctan(s) ** 2) * np.exp(slopes2[drawn] / 100)
+
+        # Long lines are split into up to four shorter, jittered ones
+        n = np.abs(l * s / r).astype(int)
+        split = np.abs(l * s) > 2 * r
+        l[split] /= n[split]
+        counts = np.where(split, np.minimum(n, 4), 1)
+        xy = np.repeat(self.vxs[goodidxs[land[drawn]]], counts, axis=0)
+        uv = np.random.normal(0, r / 2, xy.shape)
+        uv[~np.repeat(split, counts)] = 0
+        xy += uv
+        dxy = np.repeat(np.column_stack([l, l * s]), counts, axis=0)
+        slopelines = np.stack([xy - dxy, xy + dxy], axis=1)
+
+        # Adjust slope values to fit cmap
+        # sin(arctan(s)), without the two transcendental calls
+        land_angles = slopes / np.hypot(1, slopes)
+
+        print(f"Slopes")
+        print(f"Max: {land_angles.max()}")
+        print(f"Min: {land_angles.min()}")
+        print(f"Avg: {land_angles.mean()}")
+
+        # Tone down gradient difference, centred at 0.5 (flat ground = 0.5)
+        land_slopes = slopes * 0.5 + 0.5
+        land_angles *= 0.7
+        land_angles += 0.5
+
+        cmap = "copper"
+        # cmap = "summer"
+
+        # Land patches
+        land_heights = elevations[land]
+        land_heights = (land_heights - land_heights.min()) / np.ptp(land_heights)
+        land_colors = land_heights * 0.30 + 0.35 + np.random.random(len(land_heights)) * 0.02 - 0.10
+        # Colours are fixed for the whole plot, so map them through the colormap once
+        # land_rgba = cmap_colors(cmap, land_colors)
+        land_rgba = cmap_colors(cmap, land_angles)
+        # land_rgba = cmap_colors(cmap, land_slopes)
+
+        # Sea patches
+        sea = np.flatnonzero(~good_land)
+        sea_rgba = np.zeros((0, 4))
+        if len(sea) > 0:
+            # Random range of narrow range of cmap
+            sea_heights = elevations[sea]
+            sea_heights = np.abs(sea_heights) - sea_heights.min()
+            sea_heights /= sea_heights.max()
+            sea_colors = sea_heights * 0.80 + 0.10 + np.random.random(len(sea_heights)) * 0.02
+            sea_rgba = cmap_colors("Blues", sea_colors)
+
+        # Borders and coasts
+        rv = np.asarray(self.vor.ridge_vertices)
+        rp = self.vor.ridge_points
+        finite = (rv != -1).all(1) & (rp != -1).all(1)
+        rv, rp = rv[finite], rp[finite]
+        v1, v2 = rv.T
+        inside = good[v1] & good[v2]
+        borders = rp[inside & (self.territories[v1] != self.territories[v2]) & land_mask[v1] & land_mask[v2]]
+        coasts = self.pts[rp[inside & (land_mask[v1] != land_mask[v2])], :]
+        borders = mergelines(relaxpts(self.pts, borders))
+        print("Borders:", len(borders))
+        coasts = mergelines(coasts)
+
+        geometry = {
+            "good": good,
+            "land_mask": land_mask,
+            "slopelines": slopelines,
+            "land_verts": self.pts[tris[land]],
+            "land_rgba": land_rgba,
+            "sea_verts": self.pts[tris[sea]],
+            "sea_rgba": sea_rgba,
+            "borders": borders,
+            "coasts": coasts,
+        }
+        return geometry
+
+    def _build_rivers(self, good, land_mask):
+        threshold = np.percentile(self.flow, 100 - self.riverperc)
+        river = np.logical_and.reduce((good, land_mask, self.downhill != -1, self.flow > threshold))
+        us = np.flatnonzero(river)
+        rivers = relaxpts(self.vxs, np.column_stack([us, self.downhill[us]]))
+        print(len(rivers), len(us))
+        return mergelines(rivers)
+
     def plot(self, filename, rivers=True, cmap=mpl.cm.Greys, **kwargs):
         print("Plotting")
         fig = plt.figure(figsize=(6, 6))
@@ -835,114 +1064,33 @@ class MapGrid:
         patch = mpl.patches.PathPatch(path, fc="lightslategrey", ec="black", zorder=15)
         ax.add_patch(patch)
 
-        elev = np.where(self.elevation > 0, 0.1, 0)
-        good = ~self.extend_area(self.edge, 10)
-
-        goodidxs = [i for i in range(self.nvxs) if good[i]]
-        tris = [self.tris[i] for i in goodidxs]
-        elevs = elev[goodidxs]
-        elevations = self.elevation[goodidxs]
-
-        # Plot slope lines
-        slopelines = []
-        slopes = []
-        r = 0.25 * self.nvxs ** -0.5
-        for i in goodidxs:
-            # Do not put slope lines in ocean
-            if self.elevation[i] <= 0:
-                continue
-
-            t = self.tris[i]
-            s, s2 = trislope(self.pts[t, :], self.elevation_pts[t])
-            s /= 10
+        geometry = self.draw_geometry(rivers)
+        land_mask = geometry["land_mask"]
 
-            slopes.append(s)
-
-            # Do not add a line if slope is below threshold
-            if abs(s) < 0.1 + 0.3 * np.random.random():
-                continue
-
-            x, y = self.vxs[i, :]
-            l = r * (1 + np.random.random()) * (1 - 0.2 * np.arctan(s) ** 2) * np.exp(s2 / 100)
-            if abs(l * s) > 2 * r:
-                n = int(abs(l * s / r))
-                l /= n
-                uv = np.random.normal(0, r / 2, (min(n, 4), 2))
-                for u, v in uv:
-                    slopelines.append([(x + u - l, y + v - l * s), (x + u + l, y + v + l * s)])
-            else:
-                slopelines.append([(x - l, y - l * s), (x + l, y + l * s)])
-
-        slopecol = mpl.collections.LineCollection(slopelines)
+        slopecol = mpl.collections.LineCollection(geometry["slopelines"])
         slopecol.set_zorder(1)
         slopecol.set_color("black")
         slopecol.set_linewidth(0.3)
         # ax.add_collection(slopecol)
 
-        # Adjust slope values to fit cmap
-        land_slopes = np.array(slopes)
-        land_angles = np.sin(np.arctan(slopes))
-
-        print(f"Slopes")
-        print(f"Max: {max(land_angles)}")
-        print(f"Min: {min(land_angles)}")
-        print(f"Avg: {np.mean(land_angles)}")
-
-        # Tone down gradient difference
-        land_slopes *= 0.5
-        land_angles *= 0.7
-
-        # Slopes should be centered at 0.5 (flat ground = 0.5)
-        land_slopes += 0.5
-        land_angles += 0.5
-
-        cmap = "copper"
-        # cmap = "summer"
-
         # Plot land patches
-        land = np.where(elevs > 0)[0]
-        landpatches = [mpl.patches.Polygon(self.pts[tris[i], :], closed=True) for i in land]
-        landpatchcol = mpl.collections.PatchCollection(landpatches, cmap=cmap, ec="face")
-
-        land_heights = elevations[land]
-        land_heights = land_heights - min(land_heights)
-        land_heights *= 1 / max(land_heights)
-        land_colors = land_heights * 0.30 + 0.35 + np.random.random(len(land_heights)) * 0.02 - 0.10
-        # landpatchcol.set_array(land_colors)
-        landpatchcol.set_array(land_angles)
-        # landpatchcol.set_array(land_slopes)
-        landpatchcol.set_clim([0.0, 1.0])
+        landpatchcol = mpl.collections.PolyCollection(
+            geometry["land_verts"], facecolors=geometry["land_rgba"], edgecolors="face"
+        )
         landpatchcol.set_zorder(0)
         ax.add_collection(landpatchcol)
 
         # Plot sea patches
-        sea = np.where(elevs <= 0)[0]
-        if len(sea) > 0:
-            seapatches = [mpl.patches.Polygon(self.pts[tris[i], :], closed=True) for i in sea]
-            seapatchcol = mpl.collections.PatchCollection(seapatches, cmap="Blues", ec="face")
-
-            # Random range of narrow range of cmap
-            sea_heights = elevations[sea]
-            sea_heights = abs(sea_heights) - min(sea_heights)
-            sea_heights *= 1 / max(sea_heights)
-            sea_colors = sea_heights * 0.80 + 0.10 + np.random.random(len(sea_heights)) * 0.02
-            seapatchcol.set_array(sea_colors)
-            seapatchcol.set_clim([0.0, 1.0])
+        if len(geometry["sea_verts"]) > 0:
+            seapatchcol = mpl.collections.PolyCollection(
+                geometry["sea_verts"], facecolors=geometry["sea_rgba"], edgecolors="face"
+            )
             seapatchcol.set_zorder(10)
             ax.add_collection(seapatchcol)
 
         # Draw rivers
         if rivers:
-            land = (
-                good
-                & (self.elevation[:-1] > 0)
-                & (self.downhill != -1)
-                & (self.flow > np.percentile(self.flow, 100 - self.riverperc))
-            )
-            rivers = relaxpts(self.vxs, [(u, self.downhill[u]) for u in range(self.nvxs) if land[u]])
-            print(len(rivers), sum(land))
-            rivers = mergelines(rivers)
-            rivercol = mpl.collections.PathCollection(rivers, capstyle="round", joinstyle="round")
+            rivercol = mpl.collections.PathCollection(geometry["rivers"], capstyle="round", joinstyle="round")
             rivercol.set_edgecolor(self.RIVER_COLOR)
             rivercol.set_linewidth(2)
             rivercol.set_facecolor("none")
@@ -952,22 +1100,24 @@ class MapGrid:
         #Draw forests
         print("Draw forests")
         print(self.forests)
-        for forest in self.forests:
-            if forest < 2 ** sizemap:
-                    d = ax.scatter(
-                        self.vxs[forest, 0],
-                        self.vxs[forest, 1],
-                        s=5,
-                        alpha=0.5,
-                        c="green",
-                        zorder=13,
-                        linewidth=1.5,
-                    )         
+        forests = np.fromiter(self.forests, int, len(self.forests))
+        forests = forests[forests < 2 ** sizemap]
+        ax.scatter(
+            self.vxs[forests, 0],
+            self.vxs[forests, 1],
+            s=5,
+            alpha=0.5,
+            c="green",
+            zorder=13,
+            linewidth=1.5,
+        )
 
         # Draw cities
         print("Draw cities")
         bigcities = self.big_cities
-        smallcities = [c for c in self.cities if c not in bigcities]
+        is_big = np.zeros(self.nvxs, bool)
+        is_big[bigcities] = True
+        smallcities = [c for c in self.cities if not is_big[c]]
         c = ax.scatter(
             self.vxs[bigcities, 0],
             self.vxs[bigcities, 1],
@@ -990,7 +1140,7 @@ class MapGrid:
         # Draw city labels
         labelbox = dict(boxstyle="round,pad=0.1", fc="white", ec="none")
         for city in self.cities:
-            if city in bigcities:
+            if is_big[city]:
                 size = "small"
                 ytext = 12
                 stroke_lw = 2
@@ -1016,38 +1166,56 @@ class MapGrid:
             txt.set_path_effects([pe.Stroke(linewidth=stroke_lw, foreground="lightsteelblue"), pe.Normal()])
 
         # Draw region labels
+        # Score terms shared by every region: offsets from each city label and the map margins
+        vx, vy = self.vxs.T
+        city_xy = self.vxs[self.cities, :] + np.array([[0, 0.02]])
+        tree = spl.cKDTree(self.vxs)
+        city_penalty = np.where(is_big[self.cities], 4000.0, 500.0)
+        base_scores = np.where(land_mask, 0.0, -500.0)
+        base_scores[vy > 0.97] -= 50000
+        base_scores[vy < 0.03] -= 50000
+
+        # Label regions from the least to the most land
+        terrs, terr_idx = np.unique(self.territories, return_inverse=True)
+        counts = np.bincount(terr_idx, minlength=len(terrs))
+        land_counts = np.bincount(terr_idx[land_mask], minlength=len(terrs))
+
+        # Centroid of each territory, and of its land alone
+        centers = np.column_stack([np.bincount(terr_idx, weights=c, minlength=len(terrs)) for c in (vx, vy)])
+        centers /= counts[:, None]
+        landcenters = np.column_stack(
+            [np.bincount(terr_idx[land_mask], weights=c[land_mask], minlength=len(terrs)) for c in (vx, vy)]
+        )
+        with np.errstate(invalid="ignore"):
+            landcenters /= land_counts[:, None]
+
         reglabels = []
-        for terr in sorted(
-            np.unique(self.territories),
-            key=lambda t: np.sum((self.territories == t) & (self.elevation[:-1] > 0)),
-        ):
+        for t in np.argsort(land_counts, kind="stable"):
+            terr = terrs[t]
             name = self.region_names[terr]
             w = 0.06 + 0.015 * len(name)
-            region = self.territories == terr
-            landregion = region & (self.elevation[:-1] > 0)
-            scores = np.zeros(self.nvxs)
-            center = np.mean(self.vxs[region, :], 0)
-            landcenter = np.mean(self.vxs[landregion, :], 0)
-            landradius = np.mean(landregion) ** 0.5
-            scores = -5000 * distance(self.vxs, landcenter)
-            scores -= 1000 * distance(self.vxs, center)
+            region = terr_idx == t
+            center = centers[t]
+            landcenter = landcenters[t]
+            scores = -5000 * np.hypot(vx - landcenter[0], vy - landcenter[1])
+            scores -= 1000 * np.hypot(vx - center[0], vy - center[1])
             scores[~region] -= 3000
 
-            for city in self.cities:
-                dists = self.vxs - self.vxs[city, :] - np.array([[0, 0.02]])
-                exclude = (np.abs(dists[:, 0]) < w) & (np.abs(dists[:, 1]) < 0.05)
-                scores[exclude] -= 4000 if city in bigcities else 500
+            # Vertices under each city's label: a Chebyshev ball from the tree, trimmed to the label box
+            near = tree.query_ball_point(city_xy, r=max(w, 0.05), p=np.inf)
+            idx = np.fromiter(itertools.chain.from_iterable(near), np.intp)
+            which = np.repeat(np.arange(len(near)), [len(i) for i in near])
+            inbox = (np.abs(vx[idx] - city_xy[which, 0]) < w) & (np.abs(vy[idx] - city_xy[which, 1]) < 0.05)
+            scores -= np.bincount(idx[inbox], weights=city_penalty[which[inbox]], minlength=self.nvxs)
 
             for rl in reglabels:
                 dists = self.vxs - rl
                 exclude = (np.abs(dists[:, 0]) < 0.15 + w) & (np.abs(dists[:, 1]) < 0.1)
                 scores[exclude] -= 5000
-            
-            scores[self.elevation[:-1] <= 0] -= 500
-            scores[self.vxs[:, 0] > 1.06 - w] -= 50000
-            scores[self.vxs[:, 0] < w - 0.06] -= 50000
-            scores[self.vxs[:, 1] > 0.97] -= 50000
-            scores[self.vxs[:, 1] < 0.03] -= 50000
+
+            scores += base_scores
+            scores[vx > 1.06 - w] -= 50000
+            scores[vx < w - 0.06] -= 50000
             assert scores.max() > -50000
 
             xy = self.vxs[np.argmax(scores), :]
@@ -1068,28 +1236,8 @@ class MapGrid:
             )
             txt.set_path_effects([pe.Stroke(linewidth=3, foreground="slategrey"), pe.Normal()])
 
-        # Make borders and coasts
-        borders = []
-        # borderadj = defaultdict(list)
-        coasts = []
-        for rv, rp in zip(self.vor.ridge_vertices, self.vor.ridge_points):
-            if -1 in rv or -1 in rp:
-                continue
-            v1, v2 = rv
-            p1, p2 = rp
-            if not (good[v1] and good[v2]):
-                continue
-            if self.territories[v1] != self.territories[v2] and self.elevation[v1] > 0 and self.elevation[v2] > 0:
-                borders.append((p1, p2))
-            if (self.elevation[v1] > 0 and self.elevation[v2] <= 0) or (
-                self.elevation[v2] > 0 and self.elevation[v1] <= 0
-            ):
-                coasts.append(self.pts[rp, :])
-
         # Draw borders
-        borders = mergelines(relaxpts(self.pts, borders))
-        print("Borders:", len(borders))
-        bordercol = mpl.collections.PathCollection(borders)
+        bordercol = mpl.collections.PathCollection(geometry["borders"])
         bordercol.set_facecolor("none")
         bordercol.set_edgecolor("black")
         bordercol.set_linestyle("--")
@@ -1098,7 +1246,7 @@ class MapGrid:
         ax.add_collection(bordercol)
 
         # Draw coasts
-        coastcol = mpl.collections.PathCollection(mergelines(coasts))
+        coastcol = mpl.collections.PathCollection(geometry["coasts"])
         coastcol.set_facecolor("none")
         coastcol.set_edgecolor("black")
         coastcol.set_zorder(11)
@@ -1106,9 +1254,9 @@ class MapGrid:
         ax.add_collection(coastcol)
 
         print("Main Road")
-        print(self.big_cities)
-        clist = self.ordered_cities(self.big_cities)
-        #smallcities = [c for c in self.cities if c not in bigcities]
+        print(bigcities)
+        clist = self.ordered_cities(bigcities)
+        #smallcities = [c for c in self.cities if not is_big[c]]
         for c in clist:
             print(c)
         clist = ["topleft"] + list(clist) + ["bottomright"]
@@ -1121,7 +1269,7 @@ class MapGrid:
 
 
         #print("Small Roads")
-        #smallcities = [c for c in self.cities if c not in self.big_cities]
+        #smallcities = [c for c in self.cities if not is_big[c]]
         #print(smallcities)
         #print(self.big_cities)
 